@@ -3,33 +3,191 @@ from __future__ import unicode_literals
 from __future__ import print_function
 import os
 import datetime
+from collections import OrderedDict
+import hashlib
+import logging
+import math
+import re
+import threading
+import time
 
 from cryptacular.bcrypt import BCRYPTPasswordManager
-from markdown import markdown
+from markdown import Markdown
+from markdown.extensions.fenced_code import FencedBlockPreprocessor
+from markdown.postprocessors import Postprocessor
 from pyramid.authentication import AuthTktAuthenticationPolicy
 from pyramid.authorization import ACLAuthorizationPolicy
 from pyramid.config import Configurator
+from pyramid.events import NewRequest, subscriber
 from pyramid.httpexceptions import (
     HTTPFound,
     HTTPNotFound,
     HTTPForbidden
 )
+from pyramid.request import Request
 from pyramid.response import Response
 from pyramid.security import remember, forget
+from pyramid.settings import asbool
 from pyramid.view import (
     view_config,
     notfound_view_config,
     forbidden_view_config
 )
+from repoze.lru import LRUCache
 import sqlalchemy as sa
+from sqlalchemy import event
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.exc import DBAPIError
-from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.exc import DBAPIError, DisconnectionError
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import Session, scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool
+import transaction
 from waitress import serve
 from zope.sqlalchemy import ZopeTransactionExtension
 
 
-DBSession = scoped_session(sessionmaker(extension=ZopeTransactionExtension()))
+class ReplicaSet(object):
+    """read replicas chosen by round-robin or least-connections
+
+    A replica whose connection fails is ejected, and only let back in once
+    ``retry`` seconds have passed and a test query on it succeeds.  Pooled
+    connections are tested as they are checked out, so that connections
+    left over from before a replica went away are replaced (or the replica
+    ejected) before a query runs on them.
+    """
+
+    def __init__(self, engines, strategy='round-robin', retry=30):
+        if strategy not in ('round-robin', 'least-connections'):
+            raise ValueError('unknown replica strategy: {}'.format(strategy))
+        self.engines = list(engines)
+        self.strategy = strategy
+        self.retry = retry
+        self.lock = threading.Lock()
+        self.checked_out = dict((engine, 0) for engine in self.engines)
+        self.ejected = {}
+        self.turn = 0
+        for engine in self.engines:
+            self._listen(engine)
+
+    def _listen(self, engine):
+        def checkout(dbapi_connection, record, proxy):
+            try:
+                cursor = dbapi_connection.cursor()
+                cursor.execute('SELECT 1')
+                cursor.close()
+            except engine.dialect.dbapi.Error:
+                # the pool reconnects, and if that fails the replica is
+                # ejected by handle_error
+                raise DisconnectionError()
+            with self.lock:
+                self.checked_out[engine] += 1
+
+        def checkin(dbapi_connection, record):
+            with self.lock:
+                self.checked_out[engine] -= 1
+
+        def handle_error(context):
+            if context.is_disconnect or context.connection is None:
+                self.eject(engine)
+
+        event.listen(engine, 'checkout', checkout)
+        event.listen(engine, 'checkin', checkin)
+        event.listen(engine, 'handle_error', handle_error)
+
+    def eject(self, engine, now=None):
+        if now is None:
+            now = time.time()
+        with self.lock:
+            self.ejected[engine] = now + self.retry
+
+    def check(self, engine):
+        """run a test query on engine, ejecting it if that fails"""
+        try:
+            connection = engine.connect()
+            try:
+                connection.scalar(sa.select([1]))
+            finally:
+                connection.close()
+        except DBAPIError:
+            self.eject(engine)
+            return False
+        with self.lock:
+            self.ejected.pop(engine, None)
+        return True
+
+    def choose(self, now=None):
+        """pick a healthy replica, or None if every one is ejected"""
+        if now is None:
+            now = time.time()
+        with self.lock:
+            expired = [e for e, t in self.ejected.items() if t <= now]
+            # push the deadline back so that only this caller checks them
+            for engine in expired:
+                self.ejected[engine] = now + self.retry
+        for engine in expired:
+            self.check(engine)
+
+        with self.lock:
+            healthy = [e for e in self.engines if e not in self.ejected]
+            if not healthy:
+                return None
+            if self.strategy == 'least-connections':
+                return min(healthy, key=lambda e: self.checked_out[e])
+            self.turn += 1
+            return healthy[self.turn % len(healthy)]
+
+
+class RoutingSession(Session):
+    """a session that reads from replicas until it needs the primary
+
+    Once the session flushes a write, or ``use_primary`` is set, every
+    query goes to the primary until the session is closed, so reads that
+    follow a write see it.
+    """
+
+    def __init__(self, replicas=None, **kwargs):
+        super(RoutingSession, self).__init__(**kwargs)
+        self.replicas = replicas
+        self.use_primary = False
+        self.replica = None
+
+    def get_bind(self, mapper=None, clause=None):
+        if self.replicas is not None and not self.use_primary:
+            if self.replica is None or self.replica in self.replicas.ejected:
+                self.replica = self.replicas.choose()
+            if self.replica is not None:
+                return self.replica
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+    def connection(self, *args, **kwargs):
+        try:
+            return super(RoutingSession, self).connection(*args, **kwargs)
+        except DBAPIError:
+            # a replica that failed to connect has just been ejected, so a
+            # second try goes to another replica or the primary
+            if self.replica is None \
+                    or self.replica not in self.replicas.ejected:
+                raise
+            return super(RoutingSession, self).connection(*args, **kwargs)
+
+    def reset_routing(self, use_primary=False):
+        self.use_primary = use_primary
+        self.replica = None
+
+    def close(self):
+        super(RoutingSession, self).close()
+        self.reset_routing()
+
+
+@event.listens_for(RoutingSession, 'before_flush')
+def stick_to_primary(session, flush_context, instances):
+    session.use_primary = True
+
+
+DBSession = scoped_session(sessionmaker(
+    class_=RoutingSession,
+    extension=ZopeTransactionExtension()
+))
 Base = declarative_base()
 
 # make a module-level constant for the connection URI
@@ -39,6 +197,120 @@ DATABASE_URL = os.environ.get(
 
 HERE = os.path.dirname(os.path.abspath(__file__))
 
+# clients that just wrote get this cookie and read from the primary for a
+# few seconds, so they see their change despite replication lag
+PRIMARY_COOKIE = 'journal_primary'
+
+log = logging.getLogger(__name__)
+
+# default request limits, as 'requests/seconds', applied to POSTs per client
+# address and per username; override with RATELIMIT_<ROUTE>, empty disables
+RATE_LIMITS = {
+    'login': '10/60',
+    'add': '30/60',
+    'update': '30/60',
+}
+
+
+# rendered html of top-level markdown blocks, keyed by a hash of the block;
+# only blocks up to MARKDOWN_CACHE_BLOCK characters of html are kept, so
+# the cache holds at most about 2048 * 8KB no matter what is posted
+MARKDOWN_CACHE = LRUCache(2048)
+MARKDOWN_CACHE_BLOCK = 8192
+MARKDOWN_EXTENSIONS = ['codehilite', 'fenced_code']
+# a blank line followed by one of these continues the previous block
+CONTINUATION_RE = re.compile(r'^(\s|[*+-]\s|\d+\.\s|>)')
+# reference definitions and raw html reach across blocks, so any text that
+# has them is rendered whole
+WHOLE_DOCUMENT_RE = re.compile(r'^( {0,3}\[[^\]]+\]:|[ \t]*<)', re.MULTILINE)
+
+_markdown = threading.local()
+
+
+def split_blocks(text):
+    """split markdown into top-level blocks that render independently
+
+    Blocks only break at a blank line followed by an unindented line that
+    can't continue a list or blockquote, and never inside a fenced code
+    block, so rendering each block and joining the results with newlines
+    gives exactly the html of rendering the whole text.
+    """
+    # normalize whitespace the way markdown does before it parses anything
+    text = text.replace('\r\n', '\n').replace('\r', '\n').expandtabs(4)
+    text = re.sub(r'(?<=\n) +\n', '\n', text)
+    if WHOLE_DOCUMENT_RE.search(text):
+        return [text]
+
+    fences = [
+        (m.start(), m.end())
+        for m in FencedBlockPreprocessor.FENCED_BLOCK_RE.finditer(text)
+    ]
+    blocks = []
+    current = []
+    offset = 0
+    has_text = blank = False
+    for line in text.split('\n'):
+        if not line.strip(' '):
+            # only a blank line after some text can end a block
+            blank = has_text
+        else:
+            fenced = any(start < offset < end for start, end in fences)
+            if blank and line.strip() and not fenced \
+                    and not CONTINUATION_RE.match(line):
+                blocks.append('\n'.join(current))
+                current = []
+            has_text = has_text or bool(line.strip())
+            blank = False
+        current.append(line)
+        offset += len(line) + 1
+    blocks.append('\n'.join(current))
+    return blocks
+
+
+class KeepWhitespacePostprocessor(Postprocessor):
+    """remember the html before markdown strips its surrounding whitespace
+
+    Highlighted code ends in whitespace that a full render keeps between
+    blocks, so cached blocks must keep it too.
+    """
+
+    def run(self, text):
+        self.markdown.unstripped = text
+        return text
+
+
+def _convert(text):
+    # Markdown instances aren't thread safe, so keep one per thread
+    md = getattr(_markdown, 'md', None)
+    if md is None:
+        md = _markdown.md = Markdown(
+            output_format='html5',
+            extensions=MARKDOWN_EXTENSIONS
+        )
+        md.postprocessors.add(
+            'keep_whitespace', KeepWhitespacePostprocessor(md), '_end')
+    md.unstripped = ''
+    try:
+        md.convert(text)
+        return md.unstripped
+    finally:
+        md.reset()
+
+
+def render_markdown(text):
+    """render markdown to html, reusing cached html of unchanged blocks"""
+    html = []
+    for block in split_blocks(text):
+        key = hashlib.sha1(block.encode('utf-8')).hexdigest()
+        rendered = MARKDOWN_CACHE.get(key)
+        if rendered is None:
+            rendered = _convert(block)
+            if len(rendered) <= MARKDOWN_CACHE_BLOCK:
+                MARKDOWN_CACHE.put(key, rendered)
+        if rendered:
+            html.append(rendered)
+    return '\n'.join(html).strip()
+
 
 class Entry(Base):
     __tablename__ = 'entries'
@@ -82,11 +354,231 @@ class Entry(Base):
 
     @property
     def make_md(self):
-        return markdown(
-            self.text,
-            output_format='html5',
-            extensions=['codehilite', 'fenced_code']
+        return render_markdown(self.text)
+
+
+class MemoryRateLimitStore(object):
+    """in-process token buckets, one per key
+
+    At most ``max_keys`` buckets are kept, evicting the least recently used
+    first, so a flood of new keys can't grow the store without bound.
+
+    Any object with the same ``take`` method can be plugged in through the
+    RATELIMIT_STORE setting, e.g. one backed by a shared cache so that the
+    limits hold across worker processes.
+    """
+
+    def __init__(self, settings=None, max_keys=10000):
+        self.lock = threading.Lock()
+        self.buckets = OrderedDict()
+        self.max_keys = max_keys
+
+    def take(self, key, rate, capacity, now=None):
+        """take a token from the bucket for key
+
+        Returns 0 if a token was available, otherwise the number of seconds
+        until one will be.
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            tokens, stamp, _, _ = self.buckets.pop(
+                key, (capacity, now, rate, capacity))
+            tokens = min(capacity, tokens + (now - stamp) * rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = (1 - tokens) / rate
+            # reinserting keeps the buckets in least recently used order
+            self.buckets[key] = (tokens, now, rate, capacity)
+            self._prune(now)
+        return wait
+
+    def _prune(self, now):
+        # a bucket that has refilled is the same as no bucket at all
+        while self.buckets:
+            key = next(iter(self.buckets))
+            tokens, stamp, rate, capacity = self.buckets[key]
+            if tokens + (now - stamp) * rate < capacity:
+                break
+            del self.buckets[key]
+        while len(self.buckets) > self.max_keys:
+            self.buckets.popitem(last=False)
+
+
+def parse_limit(limit):
+    """parse 'requests/seconds' into a (capacity, period) tuple"""
+    if not limit:
+        return None
+    capacity, _, period = limit.partition('/')
+    capacity, period = int(capacity), float(period or 1)
+    if capacity <= 0 or period <= 0:
+        return None
+    return capacity, period
+
+
+class RateLimiter(object):
+    """token-bucket limits per route, checked against any number of keys"""
+
+    def __init__(self, limits, store):
+        self.limits = limits
+        self.store = store
+
+    def check(self, route, keys):
+        """take a token for each key, returning seconds to wait or 0
+
+        Stops at the first key that is over its limit, so a rejected
+        request doesn't create buckets for the keys after it.
+        """
+        limit = self.limits.get(route)
+        if limit is None:
+            return 0
+        capacity, period = limit
+        rate = capacity / period
+        for key in keys:
+            wait = self.store.take('{}:{}'.format(route, key), rate, capacity)
+            if wait:
+                return wait
+        return 0
+
+
+def client_address(request):
+    """the address of the client, as seen by the first trusted proxy
+
+    Behind a proxy or router every request comes from the proxy's address.
+    With RATELIMIT_PROXY_HOPS set to the number of proxies in front of the
+    app, the client is read from the X-Forwarded-For entry the outermost of
+    them appended; anything further left was sent by the client and could
+    be forged.
+    """
+    hops = request.registry.settings.get('ratelimit.proxy_hops', 0)
+    if hops:
+        forwarded = request.headers.get('X-Forwarded-For', '').split(',')
+        forwarded = [addr.strip() for addr in forwarded if addr.strip()]
+        if len(forwarded) >= hops:
+            return forwarded[-hops]
+    return request.remote_addr
+
+
+def rate_limited(request, route, username=None):
+    """return a 429 response if this client is over the route's limit
+
+    This is checked before any bcrypt or database work, so rejecting a
+    flood of requests stays cheap.
+    """
+    limiter = getattr(request.registry, 'ratelimiter', None)
+    if limiter is None:
+        return None
+    keys = ['ip:{}'.format(client_address(request))]
+    if username:
+        keys.append('user:{}'.format(username))
+    wait = limiter.check(route, keys)
+    if not wait:
+        return None
+    response = Response('Too Many Requests', status='429 Too Many Requests')
+    response.headers['Retry-After'] = str(int(math.ceil(wait)))
+    return response
+
+
+@subscriber(NewRequest)
+def route_queries(event):
+    """send this request's queries to the primary unless it can use a replica
+
+    Only GET requests from clients that haven't just written go to the
+    replicas.  Routing starts afresh for every request, in case a session
+    was left open by a request that failed.
+    """
+    request = event.request
+    DBSession().reset_routing(
+        request.method != 'GET' or PRIMARY_COOKIE in request.cookies)
+
+
+def remember_write(request, response):
+    """keep this client's reads on the primary while replicas catch up"""
+    if getattr(request.registry, 'replicas', None) is not None:
+        response.set_cookie(
+            PRIMARY_COOKIE,
+            '1',
+            max_age=request.registry.settings['db.read_sticky']
         )
+    return response
+
+
+def warm_up(app, engines=(), pool_size=None, entries=10):
+    """prime a freshly started worker before it accepts traffic
+
+    Opens the pooled database connections (``pool_size`` of them, or as many
+    as each engine's pool keeps), then requests the homepage, the
+    login form, a missing entry (for the 404 template) and the newest
+    entries, which compiles their templates, imports the Pygments lexers and
+    fills the markdown cache.  Returns the (path, status) of each request.
+    """
+    for engine in engines:
+        size = pool_size
+        if size is None:
+            size = engine.pool.size() if isinstance(
+                engine.pool, QueuePool) else 1
+        try:
+            connections = [engine.connect() for x in range(size)]
+        except DBAPIError:
+            # a replica that is down has been ejected, carry on without it
+            log.exception('could not connect to %s', engine.url)
+            continue
+        for connection in connections:
+            connection.close()
+
+    with transaction.manager:
+        newest = DBSession.query(Entry.id).order_by(Entry.id.desc())
+        entry_ids = [row.id for row in newest.limit(entries)]
+
+    paths = ['/', '/login', '/entry/0']
+    paths.extend('/entry/{}'.format(entry_id) for entry_id in entry_ids)
+    results = []
+    for path in paths:
+        response = Request.blank(path).get_response(app)
+        results.append((path, response.status_int))
+    return results
+
+
+def warm_up_until_ready(app, engines=(), retry=5):
+    """warm the worker up, then mark it ready for /health
+
+    Runs in the background while the server starts taking connections.  If
+    warming up raises or any page answers with a server error it tries again
+    every ``retry`` seconds, and the worker reports itself as warming up
+    until it succeeds.
+    """
+    settings = app.registry.settings
+    while True:
+        try:
+            results = warm_up(
+                app, engines, entries=settings['warmup.entries'])
+        except Exception:
+            # anything escaping here would end the thread and leave /health
+            # answering 503 for good
+            log.exception('warm-up failed, retrying in %s seconds', retry)
+        else:
+            failed = [path for path, status in results if status >= 500]
+            if not failed:
+                settings['journal.ready'] = True
+                return
+            log.error('warm-up got server errors from %s, retrying in %s '
+                      'seconds', ', '.join(failed), retry)
+        time.sleep(retry)
+
+
+def make_engine(url, pool_size=0):
+    """create an engine, sizing its pool if the dialect's pool takes a size
+
+    File-backed SQLite uses a NullPool, which rejects ``pool_size``.
+    """
+    url = make_url(url)
+    engine_args = {}
+    poolclass = url.get_dialect().get_pool_class(url)
+    if pool_size and issubclass(poolclass, QueuePool):
+        engine_args['pool_size'] = pool_size
+    return sa.create_engine(url, **engine_args)
 
 
 def init_db():
@@ -122,6 +614,10 @@ def add_entry(request):
     error = ""
 
     if request.method == 'POST':
+        limited = rate_limited(request, 'add', request.authenticated_userid)
+        if limited is not None:
+            return limited
+
         title = request.params.get('title')
         text = request.params.get('text')
 
@@ -140,7 +636,8 @@ def add_entry(request):
             data['text'] = text
         else:
             Entry.write(title=title, text=text)
-            return HTTPFound(request.route_url('home'))
+            return remember_write(
+                request, HTTPFound(request.route_url('home')))
 
     return {'data': data, 'current': 'add', 'error': error}
 
@@ -153,6 +650,14 @@ def update_entry(request):
     if not request.authenticated_userid:
         raise HTTPForbidden
 
+    if request.method == 'POST':
+        limited = rate_limited(
+            request, 'update', request.authenticated_userid)
+        if limited is not None:
+            return limited
+
+    # the form is saved over the entry, so it must show the latest text
+    DBSession().use_primary = True
     entry_id = request.matchdict['entry_id']
     data = Entry.get_entry(entry_id)
     error = ""
@@ -178,7 +683,8 @@ def update_entry(request):
             error = "'Entry title' and 'Entry text' may not be empty!"
         else:
             Entry.update_entry(entry_id=entry_id, title=title, text=text)
-            return HTTPFound(request.route_url('home'))
+            return remember_write(
+                request, HTTPFound(request.route_url('home')))
 
     return {'data': data, 'current': 'update', 'error': error}
 
@@ -205,6 +711,14 @@ def db_exception(context, request):
     return response
 
 
+@view_config(route_name='health')
+def health(request):
+    """tell the load balancer whether this worker is warmed up"""
+    if not request.registry.settings.get('journal.ready'):
+        return Response('warming up', status='503 Service Unavailable')
+    return Response('ok')
+
+
 @view_config(route_name='login', renderer="templates/login.jinja2")
 def login(request):
     """authenticate a user by username/password"""
@@ -212,6 +726,10 @@ def login(request):
     error = ''
 
     if request.method == 'POST':
+        limited = rate_limited(request, 'login', username)
+        if limited is not None:
+            return limited
+
         error = "Login Failed"
         authenticated = False
         try:
@@ -260,10 +778,37 @@ def main():
         'AUTH_PASSWORD', manager.encode('secret')
     )
 
+    settings['warmup'] = asbool(os.environ.get('WARMUP', False))
+    settings['warmup.entries'] = int(os.environ.get('WARMUP_ENTRIES', 10))
+    settings['db.pool_size'] = int(os.environ.get('DB_POOL_SIZE', 0))
+    read_urls = os.environ.get('DATABASE_READ_URLS', '')
+    settings['db.read_urls'] = [
+        url.strip() for url in read_urls.split(',') if url.strip()
+    ]
+    settings['db.read_strategy'] = os.environ.get(
+        'DATABASE_READ_STRATEGY', 'round-robin')
+    settings['db.read_sticky'] = int(os.environ.get('DATABASE_READ_STICKY', 5))
+
+    engines = []
+    replicas = None
     if not os.environ.get('TESTING', False):
         # only bind the session if we are not testing
-        engine = sa.create_engine(DATABASE_URL)
-        DBSession.configure(bind=engine)
+        engines = [
+            make_engine(url, settings['db.pool_size'])
+            for url in [DATABASE_URL] + settings['db.read_urls']
+        ]
+        if settings['db.read_urls']:
+            replicas = ReplicaSet(
+                engines[1:], strategy=settings['db.read_strategy'])
+        DBSession.configure(bind=engines[0], replicas=replicas)
+
+    for route, limit in RATE_LIMITS.items():
+        key = 'RATELIMIT_{}'.format(route.upper())
+        settings['ratelimit.' + route] = os.environ.get(key, limit)
+    settings['ratelimit.store'] = os.environ.get(
+        'RATELIMIT_STORE', 'journal.MemoryRateLimitStore')
+    settings['ratelimit.proxy_hops'] = int(
+        os.environ.get('RATELIMIT_PROXY_HOPS', 0))
 
     auth_secret = os.environ.get('JOURNAL_AUTH_SECRET', 'itsaseekrit')
 
@@ -289,8 +834,27 @@ def main():
     config.add_route('login', '/login')
     config.add_route('logout', '/logout')
 
+    config.add_route('health', '/health')
+
+    limits = {}
+    for route in RATE_LIMITS:
+        limits[route] = parse_limit(settings['ratelimit.' + route])
+    store = config.maybe_dotted(settings['ratelimit.store'])(settings)
+    config.registry.ratelimiter = RateLimiter(limits, store)
+    config.registry.replicas = replicas
+
     config.scan()
     app = config.make_wsgi_app()
+
+    settings = app.registry.settings
+    settings['journal.ready'] = not settings['warmup']
+    if settings['warmup']:
+        # the server binds its port while this runs, and /health keeps the
+        # load balancer away until the worker is warm
+        warmer = threading.Thread(
+            target=warm_up_until_ready, args=(app, engines), name='warm-up')
+        warmer.daemon = True
+        warmer.start()
     return app
 
 
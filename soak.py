@@ -0,0 +1,467 @@
+# -*- coding: utf-8 -*-
+"""Concurrency soak harness for the learning journal.
+
+Runs the real wsgi app under waitress on a local port, backed by a
+throwaway SQLite file (or any DATABASE_URL you point it at), and drives
+mixed read/write/login traffic from many concurrent clients.  At the end
+it reports throughput, error rates, latency percentiles and any database
+sessions or pooled connections that were left open.
+
+    python soak.py --clients 20 --duration 30
+    python soak.py --database-url postgresql://ajw@localhost/soak-journal
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+import argparse
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+try:
+    from urllib import urlencode
+    from urllib2 import (
+        build_opener,
+        HTTPCookieProcessor,
+        HTTPError,
+        HTTPRedirectHandler,
+        URLError
+    )
+    from cookielib import CookieJar
+except ImportError:
+    from urllib.parse import urlencode
+    from urllib.request import (
+        build_opener,
+        HTTPCookieProcessor,
+        HTTPRedirectHandler
+    )
+    from urllib.error import HTTPError, URLError
+    from http.cookiejar import CookieJar
+
+import sqlalchemy as sa
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+import transaction
+from waitress.server import create_server
+
+import journal
+
+DEFAULT_MIX = 'home=50,entry=30,add=10,update=5,login=5'
+# the status each operation answers with when it succeeds; writes and
+# logins redirect, and a failed login re-renders the form with a 200
+EXPECTED_STATUS = {
+    'home': 200,
+    'entry': 200,
+    'add': 302,
+    'update': 302,
+    'login': 302,
+}
+PERCENTILES = (50, 90, 99)
+
+
+def parse_mix(mix):
+    """turn 'home=50,entry=30' into [('home', 50), ('entry', 30)]"""
+    ops = []
+    for part in mix.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise ValueError('unknown operation: {}'.format(name))
+        ops.append((name, int(weight or 1)))
+    return ops
+
+
+def percentile(values, pct):
+    """nearest-rank percentile of an unsorted list of numbers"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = int(math.ceil(pct / 100.0 * len(ordered))) - 1
+    return ordered[max(0, min(rank, len(ordered) - 1))]
+
+
+class Stats(object):
+    """thread-safe collector for per-operation latencies and statuses"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.statuses = {}
+
+    def record(self, op, status, elapsed):
+        with self.lock:
+            self.latencies.setdefault(op, []).append(elapsed)
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            if status != EXPECTED_STATUS[op]:
+                self.errors[op] = self.errors.get(op, 0) + 1
+
+
+class LeakTracker(object):
+    """count pooled connections and session transactions left open"""
+
+    def __init__(self, engines):
+        self.engines = engines
+        self.lock = threading.Lock()
+        self.checked_out = 0
+        self.open_transactions = set()
+
+    def _checkout(self, dbapi_conn, record, proxy):
+        with self.lock:
+            self.checked_out += 1
+
+    def _checkin(self, dbapi_conn, record):
+        with self.lock:
+            self.checked_out -= 1
+
+    def _begin(self, session, trans, connection):
+        with self.lock:
+            self.open_transactions.add(id(trans))
+
+    def _end(self, session, trans):
+        with self.lock:
+            self.open_transactions.discard(id(trans))
+
+    def listeners(self):
+        listeners = [
+            (Session, 'after_begin', self._begin),
+            (Session, 'after_transaction_end', self._end),
+        ]
+        for engine in self.engines:
+            listeners.append((engine.pool, 'checkout', self._checkout))
+            listeners.append((engine.pool, 'checkin', self._checkin))
+        return listeners
+
+    def start(self):
+        for target, name, fn in self.listeners():
+            event.listen(target, name, fn)
+
+    def stop(self):
+        for target, name, fn in self.listeners():
+            event.remove(target, name, fn)
+
+
+class NoRedirectHandler(HTTPRedirectHandler):
+    """report redirects rather than following them
+
+    Otherwise every write would also time the homepage it redirects to.
+    """
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+def _request(opener, url, data=None):
+    """issue one request, returning its http status (0 on failure)"""
+    if data is not None:
+        data = urlencode(data).encode('utf-8')
+    try:
+        response = opener.open(url, data, timeout=30)
+        response.read()
+        response.close()
+        return response.getcode()
+    except HTTPError as e:
+        e.read()
+        return e.code
+    except (URLError, IOError):
+        return 0
+
+
+def op_home(client):
+    return _request(client.opener, client.base_url + '/')
+
+
+def op_entry(client):
+    entry_id = client.random.choice(client.entry_ids)
+    return _request(client.opener, '{}/entry/{}'.format(
+        client.base_url, entry_id))
+
+
+def op_add(client):
+    n = client.random.randint(0, 1000000)
+    data = {
+        'title': 'Soak {}'.format(n),
+        'text': '* soak\n* entry {}'.format(n),
+    }
+    return _request(client.opener, client.base_url + '/add', data)
+
+
+def op_update(client):
+    entry_id = client.random.choice(client.entry_ids)
+    data = {
+        'entry_id': entry_id,
+        'title': 'Updated {}'.format(entry_id),
+        'text': 'updated by client {}'.format(client.number),
+    }
+    return _request(client.opener, '{}/update/{}'.format(
+        client.base_url, entry_id), data)
+
+
+def op_login(client):
+    return _request(client.opener, client.base_url + '/login', client.creds)
+
+
+OPERATIONS = {
+    'home': op_home,
+    'entry': op_entry,
+    'add': op_add,
+    'update': op_update,
+    'login': op_login,
+}
+
+
+class Client(threading.Thread):
+    """one simulated user with its own cookie jar"""
+
+    def __init__(self, number, base_url, mix, deadline, entry_ids, creds,
+                 stats):
+        super(Client, self).__init__(name='soak-client-{}'.format(number))
+        self.daemon = True
+        self.number = number
+        self.base_url = base_url
+        self.deadline = deadline
+        self.entry_ids = entry_ids
+        self.creds = creds
+        self.stats = stats
+        self.random = random.Random(number)
+        self.opener = build_opener(
+            HTTPCookieProcessor(CookieJar()), NoRedirectHandler())
+        self.choices = []
+        for name, weight in mix:
+            self.choices.extend([name] * weight)
+
+    def call(self, op):
+        """run one operation, counting anything it raises as status 0"""
+        try:
+            return OPERATIONS[op](self)
+        except Exception:
+            # a dead client would otherwise just quietly lower the load
+            traceback.print_exc()
+            return 0
+
+    def run(self):
+        # every client logs in once so that add/update are authorized
+        self.call('login')
+        while time.time() < self.deadline:
+            op = self.random.choice(self.choices)
+            start = time.time()
+            status = self.call(op)
+            self.stats.record(op, status, time.time() - start)
+
+
+def seed(engine, count):
+    """create the schema and write some entries for clients to read"""
+    journal.Base.metadata.create_all(engine)
+    session = sa.orm.sessionmaker(bind=engine)()
+    for x in range(count):
+        session.add(journal.Entry(
+            title='Seed {}'.format(x),
+            text='Seed entry **{}**\n\n    :::python\n    x = {}'.format(x, x)
+        ))
+    session.commit()
+    ids = [row.id for row in session.query(journal.Entry.id)]
+    session.close()
+    return ids
+
+
+def check_mix(mix, seed_entries):
+    """parse the mix, refusing ops that need entries when none are seeded"""
+    ops = parse_mix(mix)
+    if seed_entries < 1:
+        needy = [name for name, weight in ops
+                 if weight and name in ('entry', 'update')]
+        if needy:
+            raise ValueError('{} need at least one seeded entry'.format(
+                ' and '.join(needy)))
+    return ops
+
+
+def run_soak(database_url, clients=10, duration=10.0, threads=4,
+             mix=DEFAULT_MIX, seed_entries=20, username='admin',
+             password='secret', rate_limit=False, read_urls=()):
+    """run the soak and return a report dict
+
+    Any read_urls are seeded like the primary and used as read replicas.
+    """
+    ops = check_mix(mix, seed_entries)
+    engine = sa.create_engine(database_url)
+    read_engines = [sa.create_engine(url) for url in read_urls]
+    tracker = LeakTracker([engine] + read_engines)
+    testing = os.environ.get('TESTING')
+    previous = dict(journal.DBSession.session_factory.kw)
+    started = False
+    try:
+        entry_ids = seed(engine, seed_entries)
+        for read_engine in read_engines:
+            seed(read_engine, seed_entries)
+        replicas = journal.ReplicaSet(read_engines) if read_engines else None
+
+        # bind the session ourselves, the way the test suite does, so that
+        # the tracker can watch the same engine the app is using
+        os.environ['TESTING'] = 'True'
+        try:
+            app = journal.main()
+        finally:
+            if testing is None:
+                del os.environ['TESTING']
+        journal.DBSession.remove()
+        journal.DBSession.configure(bind=engine, replicas=replicas)
+        app.registry.replicas = replicas
+        if not rate_limit:
+            # every client shares 127.0.0.1, so the limits would swamp it
+            app.registry.ratelimiter = None
+
+        tracker.start()
+        started = True
+
+        server = create_server(app, host='127.0.0.1', port=0,
+                               threads=threads)
+        port = server.socket.getsockname()[1]
+        server_thread = threading.Thread(target=server.run,
+                                         name='soak-server')
+        server_thread.daemon = True
+        server_thread.start()
+
+        stats = Stats()
+        creds = {'username': username, 'password': password}
+        base_url = 'http://127.0.0.1:{}'.format(port)
+        start = time.time()
+        try:
+            workers = [
+                Client(n, base_url, ops, start + duration, entry_ids,
+                       creds, stats)
+                for n in range(clients)
+            ]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        finally:
+            elapsed = time.time() - start
+            server.task_dispatcher.shutdown()
+            server.close()
+    finally:
+        # the harness thread may have touched the scoped session while
+        # binding
+        journal.DBSession.remove()
+        transaction.abort()
+        if started:
+            tracker.stop()
+        for each in [engine] + read_engines:
+            each.dispose()
+        journal.DBSession.configure(
+            bind=previous.get('bind'), replicas=previous.get('replicas'))
+
+    report = {
+        'elapsed': elapsed,
+        'clients': clients,
+        'threads': threads,
+        'statuses': stats.statuses,
+        'operations': {},
+        'leaked_connections': tracker.checked_out,
+        'leaked_sessions': len(tracker.open_transactions),
+    }
+    total = 0
+    for op, latencies in stats.latencies.items():
+        total += len(latencies)
+        summary = {
+            'requests': len(latencies),
+            'errors': stats.errors.get(op, 0),
+            'max': max(latencies),
+        }
+        for pct in PERCENTILES:
+            summary['p{}'.format(pct)] = percentile(latencies, pct)
+        report['operations'][op] = summary
+    report['requests'] = total
+    report['errors'] = sum(stats.errors.values())
+    report['throughput'] = total / elapsed if elapsed else 0.0
+    return report
+
+
+ROW = '{:<8} {:>8} {:>7} {:>9} {:>9} {:>9} {:>9}'
+
+
+def format_report(report):
+    lines = [
+        '{requests} requests in {elapsed:.1f}s from {clients} clients '
+        '({threads} server threads): {throughput:.1f} req/s'.format(**report),
+        ROW.format('op', 'requests', 'errors', 'p50 ms', 'p90 ms', 'p99 ms',
+                   'max ms'),
+    ]
+    for op in sorted(report['operations']):
+        s = report['operations'][op]
+        lines.append(ROW.format(
+            op, s['requests'], s['errors'], '{:.1f}'.format(s['p50'] * 1000),
+            '{:.1f}'.format(s['p90'] * 1000), '{:.1f}'.format(s['p99'] * 1000),
+            '{:.1f}'.format(s['max'] * 1000)))
+    error_rate = 100.0 * report['errors'] / report['requests'] \
+        if report['requests'] else 0.0
+    lines.append('error rate: {:.2f}%  statuses: {}'.format(
+        error_rate, ', '.join('{}={}'.format(k, v) for k, v in
+                              sorted(report['statuses'].items()))))
+    lines.append('leaked sessions: {leaked_sessions}  '
+                 'leaked connections: {leaked_connections}'.format(**report))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--clients', type=int, default=10)
+    parser.add_argument('--duration', type=float, default=10.0,
+                        help='seconds to drive traffic for')
+    parser.add_argument('--threads', type=int, default=4,
+                        help='waitress worker threads')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help='weighted operations, e.g. ' + DEFAULT_MIX)
+    parser.add_argument('--seed-entries', type=int, default=20)
+    parser.add_argument('--database-url', default=None,
+                        help='a throwaway database; its tables are dropped '
+                             'afterwards (defaults to a temporary SQLite '
+                             'file)')
+    parser.add_argument('--username', default='admin')
+    parser.add_argument('--password', default='secret')
+    parser.add_argument('--replicas', type=int, default=0,
+                        help='number of SQLite read replicas to stand up')
+    parser.add_argument('--rate-limit', action='store_true',
+                        help='keep the configured request limits enabled')
+    args = parser.parse_args(argv)
+    try:
+        check_mix(args.mix, args.seed_entries)
+    except ValueError as e:
+        parser.error(str(e))
+
+    tmpdir = tempfile.mkdtemp(prefix='journal-soak-')
+    database_url = args.database_url
+    if database_url is None:
+        database_url = 'sqlite:///' + os.path.join(tmpdir, 'soak.db')
+    read_urls = [
+        'sqlite:///' + os.path.join(tmpdir, 'replica{}.db'.format(n))
+        for n in range(args.replicas)
+    ]
+    try:
+        report = run_soak(
+            database_url, clients=args.clients, duration=args.duration,
+            threads=args.threads, mix=args.mix,
+            seed_entries=args.seed_entries, username=args.username,
+            password=args.password, rate_limit=args.rate_limit,
+            read_urls=read_urls)
+    finally:
+        shutil.rmtree(tmpdir)
+        if args.database_url is not None:
+            engine = sa.create_engine(database_url)
+            journal.Base.metadata.drop_all(engine)
+            engine.dispose()
+
+    print(format_report(report))
+    # a non-zero exit lets CI fail the build on leaks
+    return 1 if report['leaked_sessions'] or report['leaked_connections'] \
+        else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,6 +2,8 @@
 from __future__ import unicode_literals
 from __future__ import print_function
 import os
+import threading
+import time
 import pytest
 from sqlalchemy.exc import IntegrityError
 from pyramid import testing
@@ -289,3 +291,417 @@ def test_get_entry(db_session, entry):
     entry = journal.Entry.get_entry(entry.id, session=db_session)
     assert entry.title == 'Test Title'
     assert entry.text == 'Test Entry Text'
+
+
+def test_rate_limit_store_take():
+    store = journal.MemoryRateLimitStore()
+    # a bucket of 2 tokens refilling at 1 token every 2 seconds
+    assert store.take('k', 0.5, 2, now=100) == 0
+    assert store.take('k', 0.5, 2, now=100) == 0
+    assert store.take('k', 0.5, 2, now=100) == 2
+    assert store.take('other', 0.5, 2, now=100) == 0
+    assert store.take('k', 0.5, 2, now=102) == 0
+
+
+def test_rate_limit_store_prunes_full_buckets():
+    store = journal.MemoryRateLimitStore()
+    for key in ('a', 'b', 'c'):
+        store.take(key, 1, 5, now=0)
+    store.take('d', 1, 5, now=10)
+    assert list(store.buckets) == ['d']
+
+
+def test_rate_limit_store_prunes_with_each_buckets_limits():
+    store = journal.MemoryRateLimitStore()
+    # a slow bucket drained to 12 of 30 tokens
+    for x in range(18):
+        store.take('add', 0.5, 30, now=0)
+    # a fast bucket with a small capacity mustn't make it look refilled
+    store.take('login', 10, 10, now=1)
+    assert store.buckets['add'][0] == 12
+
+
+def test_rate_limit_store_evicts_least_recently_used():
+    store = journal.MemoryRateLimitStore(max_keys=2)
+    store.take('a', 0.01, 5, now=0)
+    store.take('b', 0.01, 5, now=0)
+    store.take('a', 0.01, 5, now=1)
+    store.take('c', 0.01, 5, now=2)
+    assert list(store.buckets) == ['a', 'c']
+
+
+def test_rate_limiter_stops_at_first_rejected_key():
+    store = journal.MemoryRateLimitStore()
+    limiter = journal.RateLimiter({'login': (1, 60.0)}, store)
+    assert limiter.check('login', ['ip:1', 'user:a']) == 0
+    assert limiter.check('login', ['ip:1', 'user:b']) > 0
+    assert 'login:user:b' not in store.buckets
+
+
+def test_client_address(auth_req):
+    auth_req.remote_addr = '10.0.0.1'
+    auth_req.headers['X-Forwarded-For'] = '1.1.1.1, 2.2.2.2'
+    assert journal.client_address(auth_req) == '10.0.0.1'
+    auth_req.registry.settings['ratelimit.proxy_hops'] = 1
+    assert journal.client_address(auth_req) == '2.2.2.2'
+    auth_req.registry.settings['ratelimit.proxy_hops'] = 3
+    assert journal.client_address(auth_req) == '10.0.0.1'
+
+
+def test_parse_limit():
+    assert journal.parse_limit('5/60') == (5, 60.0)
+    assert journal.parse_limit('3') == (3, 1.0)
+    assert journal.parse_limit('') is None
+    assert journal.parse_limit('0/60') is None
+
+
+def test_login_rate_limited(monkeypatch):
+    from journal import main
+    from webtest import TestApp
+    monkeypatch.setenv('RATELIMIT_LOGIN', '2/60')
+    app = TestApp(main())
+    for x in range(2):
+        response = login_helper('admin', 'wrong', app)
+        assert response.status_code == 200
+    response = login_helper('admin', 'wrong', app)
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) > 0
+
+
+MARKDOWN_SAMPLES = [
+    '* one\r* two\r* three',
+    'First paragraph\r\n\r\nSecond *paragraph*\r\n\r\n## Heading',
+    'Intro\n\n```python\ndef f():\n\n    return 1\n```\n\nOutro',
+    'Code:\n\n    :::python\n    x = 1\n\nAfter the code',
+    '- a\n\n- b\n\nnot in the list\n\n1. one\n\n    more of one',
+    '> quoted\n\n> still quoted\n\nplain',
+    'A [link][ref]\n\n[ref]: http://example.com\n\nmore',
+    '<div>\nraw\n\nhtml\n</div>\n\nafter',
+    '\tcode\n\ntext\n\n---\n\n* * *',
+]
+
+
+def test_render_markdown_matches_full_render():
+    from markdown import markdown
+    for text in MARKDOWN_SAMPLES:
+        expected = markdown(
+            text,
+            output_format='html5',
+            extensions=journal.MARKDOWN_EXTENSIONS
+        )
+        journal.MARKDOWN_CACHE.clear()
+        assert journal.render_markdown(text) == expected
+        # and again from the cache
+        assert journal.render_markdown(text) == expected
+
+
+def test_split_blocks():
+    text = '# one\n\n* a\n\n* b\n\n```\nx\n\ny\n```\n\ntwo'
+    # list items stay together, as do blank lines inside fenced code
+    assert journal.split_blocks(text) == [
+        '# one\n\n* a\n\n* b\n', '```\nx\n\ny\n```\n', 'two'
+    ]
+
+
+def test_render_markdown_only_renders_changed_blocks(monkeypatch):
+    rendered = []
+    convert = journal._convert
+
+    def counting_convert(text):
+        rendered.append(text)
+        return convert(text)
+
+    monkeypatch.setattr(journal, '_convert', counting_convert)
+    journal.MARKDOWN_CACHE.clear()
+    journal.render_markdown('first\n\nsecond\n\nthird')
+    assert len(rendered) == 3
+
+    del rendered[:]
+    journal.render_markdown('first\n\nsecond, edited\n\nthird')
+    assert rendered == ['second, edited\n']
+
+
+def test_render_markdown_skips_caching_large_blocks(monkeypatch):
+    monkeypatch.setattr(journal, 'MARKDOWN_CACHE_BLOCK', 100)
+    journal.MARKDOWN_CACHE.clear()
+    journal.render_markdown('small\n\n' + 'big ' * 100)
+    assert len(journal.MARKDOWN_CACHE.data) == 1
+def test_health(app):
+    response = app.get('/health', status=200)
+    assert response.body == b'ok'
+
+
+def test_health_not_ready_while_warming_up(monkeypatch):
+    from journal import main
+    from webtest import TestApp
+    started = []
+    monkeypatch.setattr(
+        journal, 'warm_up_until_ready', lambda *args: started.append(args))
+    monkeypatch.setenv('WARMUP', '1')
+    app = TestApp(main())
+    response = app.get('/health', status=503)
+    assert response.status_code == 503
+    for thread in threading.enumerate():
+        if thread.name == 'warm-up':
+            thread.join()
+    assert len(started) == 1
+
+
+def test_warmup_off_when_false(monkeypatch):
+    from journal import main
+    monkeypatch.setenv('WARMUP', 'false')
+    assert main().registry.settings['journal.ready']
+
+
+def test_warm_up_until_ready_retries(app, db_session, monkeypatch):
+    from sqlalchemy.exc import DBAPIError, TimeoutError
+    calls = []
+    warm_up = journal.warm_up
+
+    def flaky_warm_up(*args, **kwargs):
+        calls.append(args)
+        if len(calls) == 1:
+            raise DBAPIError('select 1', {}, Exception('database is down'))
+        if len(calls) == 2:
+            raise TimeoutError('pool exhausted')
+        if len(calls) == 3:
+            return [('/', 500)]
+        return warm_up(*args, **kwargs)
+
+    monkeypatch.setattr(journal, 'warm_up', flaky_warm_up)
+    settings = app.app.registry.settings
+    settings['journal.ready'] = False
+    settings['warmup.entries'] = 5
+    journal.warm_up_until_ready(app.app, retry=0)
+    assert len(calls) == 4
+    assert settings['journal.ready']
+    app.get('/health', status=200)
+
+
+def test_warm_up(app, entry):
+    journal.MARKDOWN_CACHE.clear()
+    results = journal.warm_up(app.app, entries=5)
+    assert ('/', 200) in results
+    assert ('/login', 200) in results
+    assert ('/entry/0', 404) in results
+    assert ('/entry/{}'.format(entry.id), 200) in results
+    key = journal.hashlib.sha1(entry.text.encode('utf-8')).hexdigest()
+    assert journal.MARKDOWN_CACHE.get(key) is not None
+
+
+def test_warm_up_fills_pool(app, db_session):
+    from sqlalchemy import create_engine
+    from sqlalchemy.pool import QueuePool
+    engine = create_engine('sqlite://', poolclass=QueuePool, pool_size=3)
+    journal.warm_up(app.app, [engine], entries=1)
+    assert engine.pool.checkedin() == 3
+    engine.dispose()
+
+
+def test_make_engine_sizes_only_pools_that_take_a_size(tmpdir):
+    from sqlalchemy.pool import NullPool
+    url = 'sqlite:///' + str(tmpdir.join('pool.db'))
+    engine = journal.make_engine(url, pool_size=5)
+    assert isinstance(engine.pool, NullPool)
+
+
+@pytest.fixture()
+def replica_engines(request, tmpdir):
+    """a primary and two replicas, as separate SQLite databases"""
+    from sqlalchemy import create_engine
+    engines = []
+    for name in ('primary', 'replica0', 'replica1'):
+        engine = create_engine('sqlite:///' + str(tmpdir.join(name + '.db')))
+        journal.Base.metadata.create_all(engine)
+        engine.execute(
+            journal.Entry.__table__.insert(), title=name, text=name)
+        engines.append(engine)
+        request.addfinalizer(engine.dispose)
+    return engines
+
+
+def test_replicas_round_robin(replica_engines):
+    primary, replica0, replica1 = replica_engines
+    replicas = journal.ReplicaSet([replica0, replica1])
+    chosen = [replicas.choose() for x in range(4)]
+    assert chosen == [replica1, replica0, replica1, replica0]
+
+
+def test_replicas_least_connections(replica_engines):
+    primary, replica0, replica1 = replica_engines
+    replicas = journal.ReplicaSet(
+        [replica0, replica1], strategy='least-connections')
+    connection = replica0.connect()
+    assert replicas.choose() is replica1
+    connection.close()
+    connection = replica1.connect()
+    assert replicas.choose() is replica0
+    connection.close()
+
+
+def test_replicas_eject_failed(replica_engines, tmpdir):
+    from sqlalchemy import create_engine
+    from sqlalchemy.exc import OperationalError
+    primary, replica0, replica1 = replica_engines
+    broken = create_engine(
+        'sqlite:///' + str(tmpdir.join('missing', 'replica.db')))
+    replicas = journal.ReplicaSet([broken, replica0], retry=60)
+    with pytest.raises(OperationalError):
+        broken.connect()
+    assert broken in replicas.ejected
+    assert set(replicas.choose() for x in range(4)) == set([replica0])
+
+    replicas.eject(replica0)
+    assert replicas.choose() is None
+    # once the retry period is up a working replica is checked and let back
+    assert replicas.choose(now=time.time() + 61) is replica0
+    assert broken in replicas.ejected
+
+
+def test_routing_session(replica_engines):
+    from sqlalchemy.orm import sessionmaker
+    primary, replica0, replica1 = replica_engines
+    session = sessionmaker(
+        class_=journal.RoutingSession,
+        bind=primary,
+        replicas=journal.ReplicaSet([replica0])
+    )()
+
+    def titles():
+        # query columns, so rows with the same id in each database don't
+        # come back from the identity map
+        query = session.query(journal.Entry.title)
+        return [title for (title,) in query.order_by(journal.Entry.id.desc())]
+
+    assert titles() == ['replica0']
+
+    # after a write, reads stay on the primary
+    journal.Entry.write(title='new', text='new', session=session)
+    assert titles() == ['new', 'primary']
+    session.commit()
+    assert titles() == ['new', 'primary']
+
+    session.close()
+    assert titles() == ['replica0']
+
+    session.use_primary = True
+    assert titles() == ['new', 'primary']
+    session.close()
+
+
+def test_write_keeps_client_on_primary(app, db_session):
+    test_login_success(app)
+    entry_data = {'title': 'Hello there', 'text': 'This is a post'}
+    response = app.post('/add', params=entry_data, status='3*')
+    assert journal.PRIMARY_COOKIE not in response.headers.get('Set-Cookie', '')
+
+    app.app.registry.replicas = journal.ReplicaSet([])
+    response = app.post('/add', params=entry_data, status='3*')
+    assert journal.PRIMARY_COOKIE in response.headers['Set-Cookie']
+
+
+def test_replicas_recheck_expired_once(replica_engines):
+    primary, replica0, replica1 = replica_engines
+    replicas = journal.ReplicaSet([replica0, replica1], retry=60)
+    checked = []
+    replicas.check = checked.append
+    replicas.eject(replica0, now=0)
+    later = time.time()
+    assert replicas.choose(now=later) is replica1
+    assert replicas.choose(now=later) is replica1
+    # a second caller doesn't check it while the first one is
+    assert checked == [replica0]
+
+
+@pytest.fixture()
+def replica_app(request, monkeypatch):
+    """make an app whose main() is given a primary and read replicas"""
+    from webtest import TestApp
+    previous = dict(journal.DBSession.session_factory.kw)
+
+    def restore():
+        journal.DBSession.remove()
+        journal.DBSession.configure(
+            bind=previous.get('bind'), replicas=previous.get('replicas'))
+
+    request.addfinalizer(restore)
+
+    def make_app(primary, replicas):
+        monkeypatch.delenv('TESTING', raising=False)
+        monkeypatch.setattr(journal, 'DATABASE_URL', str(primary.url))
+        monkeypatch.setenv(
+            'DATABASE_READ_URLS', ','.join(str(e.url) for e in replicas))
+        journal.DBSession.remove()
+        return TestApp(journal.main())
+
+    return make_app
+
+
+def test_replica_app_routes_reads(replica_engines, replica_app):
+    primary, replica0, replica1 = replica_engines
+    app = replica_app(primary, [replica0])
+
+    response = app.get('/')
+    assert 'replica0' in response.body
+    assert 'primary' not in response.body
+
+    cookie = {'Cookie': str('{}=1'.format(journal.PRIMARY_COOKIE))}
+    response = app.get('/', headers=cookie)
+    assert 'primary' in response.body
+
+    # the edit form, and a POST of it, read the entry from the primary
+    test_login_success(app)
+    response = app.get('/update/1')
+    assert 'value="primary"' in response.body
+    response = app.post('/update/1', params={'title': '', 'text': ''})
+    assert 'value="primary"' in response.body
+
+    # after a write the client reads its change from the primary
+    entry_data = {'title': 'Fresh entry', 'text': 'Just written'}
+    response = app.post('/add', params=entry_data, status='3*')
+    assert 'Fresh entry' in response.follow().body
+
+
+def test_replica_app_survives_replica_going_down(
+        replica_engines, replica_app, tmpdir):
+    from sqlalchemy import create_engine
+    primary, replica0, replica1 = replica_engines
+    down = tmpdir.mkdir('down')
+    doomed = create_engine('sqlite:///' + str(down.join('replica.db')))
+    journal.Base.metadata.create_all(doomed)
+    doomed.execute(journal.Entry.__table__.insert(), title='doomed', text='x')
+    app = replica_app(primary, [replica0, doomed])
+
+    bodies = [app.get('/').body for x in range(2)]
+    assert any('doomed' in body for body in bodies)
+
+    down.remove()
+    for x in range(5):
+        response = app.get('/', status=200)
+        assert 'doomed' not in response.body
+    assert journal.DBSession().replica is not doomed
+
+
+def test_replica_app_replaces_dead_pooled_connections(
+        replica_engines, replica_app):
+    from sqlalchemy import create_engine
+    from sqlalchemy.pool import QueuePool
+    primary, replica0, replica1 = replica_engines
+    app = replica_app(primary, [])
+    pooled = create_engine(
+        str(replica0.url), poolclass=QueuePool, pool_size=1)
+    replicas = journal.ReplicaSet([pooled])
+    journal.DBSession.configure(replicas=replicas)
+    app.app.registry.replicas = replicas
+    assert 'replica0' in app.get('/').body
+
+    # the replica restarts, leaving a dead connection in the pool
+    pooled_connection = pooled.raw_connection()
+    dbapi_connection = pooled_connection.connection
+    pooled_connection.close()
+    dbapi_connection.close()
+
+    response = app.get('/', status=200)
+    assert 'replica0' in response.body
+    assert pooled not in replicas.ejected
+    pooled.dispose()
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import pytest
+
+import soak
+
+
+def test_percentile():
+    values = [5, 1, 4, 2, 3]
+    assert soak.percentile(values, 50) == 3
+    assert soak.percentile(values, 90) == 5
+    assert soak.percentile(values, 1) == 1
+    assert soak.percentile([], 99) == 0.0
+
+
+def test_parse_mix():
+    mix = soak.parse_mix('home=3, entry=1,login')
+    assert mix == [('home', 3), ('entry', 1), ('login', 1)]
+
+
+def test_parse_mix_unknown_op():
+    with pytest.raises(ValueError):
+        soak.parse_mix('home=1,delete=1')
+
+
+def test_check_mix_needs_seeded_entries():
+    with pytest.raises(ValueError):
+        soak.check_mix('home=1,entry=1', 0)
+    assert soak.check_mix('home=1,add=1', 0) == [('home', 1), ('add', 1)]
+
+
+def test_client_counts_exceptions_as_errors():
+    stats = soak.Stats()
+    client = soak.Client(0, 'http://127.0.0.1:1', [('entry', 1)], 0, [],
+                         {}, stats)
+    assert client.call('entry') == 0
+
+
+def test_stats_counts_errors():
+    stats = soak.Stats()
+    stats.record('home', 200, 0.1)
+    stats.record('home', 500, 0.2)
+    stats.record('add', 0, 0.3)
+    assert stats.errors == {'home': 1, 'add': 1}
+    assert stats.statuses == {200: 1, 500: 1, 0: 1}
+    assert len(stats.latencies['home']) == 2
+
+
+def test_run_soak(tmpdir):
+    database_url = 'sqlite:///' + str(tmpdir.join('soak.db'))
+    report = soak.run_soak(
+        database_url, clients=2, duration=1.0, threads=2, seed_entries=3)
+    assert report['requests'] > 0
+    assert report['errors'] == 0
+    assert report['leaked_sessions'] == 0
+    assert report['leaked_connections'] == 0